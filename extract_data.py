@@ -11,11 +11,161 @@ using the BioCyc and PubChem APIs.
 import os
 import sys
 import re
-from typing import Dict, List
-
+import io
+import csv
+import importlib
+from dataclasses import dataclass
+import shelve
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.error import HTTPError
+
+import requests
 import pubchempy as pcp
 from biocyc import biocyc
 
+@dataclass
+class Chem:
+    # Slots keep per-compound overhead low on large organisms
+    __slots__ = ('name', 'inchi', 'smiles')
+    name: Optional[str]
+    inchi: Optional[str]
+    smiles: Optional[str]
+
+def share_session(pool_size: int = 16) -> requests.Session:
+    # Route PubChem and BioCyc requests through one pooled keep-alive session
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    def urlopen(url: str, data: Optional[bytes] = None, **kwargs):
+        # Stands in for urllib's urlopen, which PubChemPy calls for every request
+        if data is None:
+            r = session.get(url)
+        else:
+            r = session.post(
+                url,
+                data=data,
+                headers={'Content-Type': 'application/x-www-form-urlencoded'}
+            )
+        if r.status_code >= 400:
+            raise HTTPError(url, r.status_code, r.reason, r.headers, io.BytesIO(r.content))
+        return io.BytesIO(r.content)
+
+    pcp.urlopen = urlopen
+    # BioCyc calls requests.get at module level, which a Session also provides
+    importlib.import_module('biocyc.biocyc').requests = session
+    return session
+
+# Patterns for cleaning common names
+_CLEAN_RE = re.compile(r'<[^<>]*>|[&;\[\]]')
+_PFX_RE = re.compile(r'^an? ')
+
+def _clean_name(name: str) -> str:
+    # Exclude tags, unwanted characters and leading articles from common name
+    return _PFX_RE.sub('', _CLEAN_RE.sub('', name), count=1)
+
+def _set_chem_id(chem: Dict, value: str):
+    chem['id'] = value.strip()
+
+def _set_chem_name(chem: Dict, value: str):
+    chem['name'] = _clean_name(value.strip())
+
+def _set_chem_inchi(chem: Dict, value: str):
+    chem['inchi'] = value.strip()
+
+def _set_chem_smiles(chem: Dict, value: str):
+    chem['smiles'] = value.strip()
+
+def _set_rxn_id(rxn: Dict, value: str):
+    rxn['id'] = value.strip()
+
+def _add_rxn_left(rxn: Dict, value: str):
+    rxn['left'].append(value.strip())
+
+def _add_rxn_right(rxn: Dict, value: str):
+    rxn['right'].append(value.strip())
+
+def _set_rxn_direction(rxn: Dict, value: str):
+    dir = value.strip()
+    if dir == 'REVERSIBLE':
+        rxn['direction'] = 0
+    elif dir.endswith('LEFT-TO-RIGHT'):
+        rxn['direction'] = 1
+    elif dir.endswith('RIGHT-TO-LEFT'):
+        rxn['direction'] = 2
+    else:
+        rxn['direction'] = -1
+
+# Handlers for attributes read from compounds.dat and reactions.dat records
+_CHEM_HANDLERS = {
+    'UNIQUE-ID': _set_chem_id,
+    'COMMON-NAME': _set_chem_name,
+    'NON-STANDARD-INCHI': _set_chem_inchi,
+    'INCHI': _set_chem_inchi,
+    'SMILES': _set_chem_smiles
+}
+_RXN_HANDLERS = {
+    'UNIQUE-ID': _set_rxn_id,
+    'LEFT': _add_rxn_left,
+    'RIGHT': _add_rxn_right,
+    'REACTION-DIRECTION': _set_rxn_direction
+}
+_CHEM_FIELDS = tuple(_CHEM_HANDLERS)
+_RXN_FIELDS = tuple(_RXN_HANDLERS)
+
+def _new_chem() -> Dict:
+    return dict.fromkeys(('id', 'name', 'inchi', 'smiles'))
+
+def _new_rxn() -> Dict:
+    return {'id': None, 'left': [], 'right': [], 'direction': None}
+
+def _iter_records(
+    lines: Iterable[str],
+    handlers: Dict,
+    fields: Tuple,
+    new_record: Callable
+) -> Iterator[Dict]:
+    # Records are terminated by a '//' line
+    record = new_record()
+    for line in lines:
+        if line.startswith('//'):
+            yield record
+            record = new_record()
+            continue
+        if not line.startswith(fields):
+            continue
+
+        entry_type, _, value = line.partition(' - ')
+        handler = handlers.get(entry_type.strip())
+        if handler:
+            handler(record, value)
+
+# Reaction arrows by direction, anything else is written as right-to-left
+_ARROWS = {0: ' <=> ', 1: ' -> '}
+
+def _format_chem(id: str, chem: Chem) -> str:
+    return f"{id}\t{chem.name}\t{chem.inchi or ''}\t{chem.smiles or ''}\n"
+
+def _format_rxn(values: Dict) -> str:
+    rxn_str = " + ".join(values['reactant_names'])
+    arrow = _ARROWS.get(values['direction'], ' <- ')
+    return (
+        f"{rxn_str}{arrow}{' + '.join(values['product_names'])}"
+        f"\t{' '.join(values['reactant_ids'])}"
+        f"\t{' '.join(values['product_ids'])}\n"
+    )
+
+# Sentinel for keys absent from the lookup cache
+_MISSING = object()
+
 class BioCycData:
 
     input_root = 'inputs'
@@ -24,52 +174,117 @@ class BioCycData:
     rxn_links_name = 'reaction-links.dat'
     chems_name = 'compounds.dat'
     rxns_name = 'reactions.dat'
+    cache_name = '.lookup_cache'
+    # Read buffer size for input files (4 MB)
+    read_buffering = 1 << 22
+    # Write buffer size for output files (1 MB) and lines per write call
+    write_buffering = 1 << 20
+    write_batch = 4096
+    # PubChem throttles clients to 5 requests/second, so workers share a rate limit
+    pubchem_workers = 8
+    pubchem_rate = 5
 
     def __init__(self, org: str):
         self.org = org
+        # Persistent cache of PubChem and BioCyc lookups, shared across runs
+        os.makedirs(self.output_root, exist_ok=True)
+        self.cache = shelve.open(f'{self.output_root}/{self.cache_name}')
+        self.cache_lock = threading.Lock()
+        self.rate_lock = threading.Lock()
+        self.next_request = 0.0
         self.chem_links = self.load_chem_links()
         self.rxn_links = self.load_rxn_links()
 
+    def close(self):
+        self.cache.close()
+
+    def _cache_get(self, key: str):
+        # Unreadable entries are treated as cache misses
+        with self.cache_lock:
+            try:
+                return self.cache.get(key, _MISSING)
+            except Exception:
+                return _MISSING
+
+    def _cache_set(self, key: str, value):
+        # A failed write only loses the cache entry, not the run
+        with self.cache_lock:
+            try:
+                self.cache[key] = value
+            except Exception:
+                pass
+
+    def _throttle(self):
+        # Reserve the next request slot, then wait for it outside the lock
+        with self.rate_lock:
+            now = time.monotonic()
+            slot = max(now, self.next_request)
+            self.next_request = slot + 1 / self.pubchem_rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _biocyc_lookup(self, id: str) -> Optional[Tuple]:
+        # BioCyc records differ between organism databases
+        key = f'biocyc:{biocyc.org_id}:{id}'
+        fields = self._cache_get(key)
+        if fields is _MISSING:
+            try:
+                compound = biocyc.get(id)
+            except Exception:
+                # Do not cache failed requests
+                return None
+            if compound is None:
+                fields = None
+            else:
+                fields = (compound.name, compound.inchi)
+            self._cache_set(key, fields)
+        return fields
+
+    def _pcp_lookup(self, q: str, kind: str) -> Tuple:
+        # PubChem rejects empty queries without a request, so spend no rate slot on them
+        if not q:
+            raise LookupError(f'No PubChem query for {kind}')
+        # InChI queries run to kilobytes, beyond some dbm backends' key limits
+        key = 'pubchem:' + hashlib.sha1(f'{kind}:{q}'.encode()).hexdigest()
+        fields = self._cache_get(key)
+        if fields is _MISSING:
+            # Errors from PubChem propagate uncached
+            self._throttle()
+            c = pcp.get_compounds(q, kind)
+            if c:
+                fields = (c[0].iupac_name, c[0].inchi, c[0].canonical_smiles)
+            else:
+                fields = None
+            self._cache_set(key, fields)
+        if fields is None:
+            raise LookupError(f'No PubChem compound for {kind} {q}')
+        return fields
+
     def load_chem_links(self) -> Dict:
         f = open(
-            f'{self.input_root}/{self.org}/{self.chem_links_name}'
+            f'{self.input_root}/{self.org}/{self.chem_links_name}',
+            newline='',
+            buffering=self.read_buffering
+        )
+        rows = csv.reader(
+            (line for line in f if not line.startswith('#')),
+            delimiter='\t',
+            quoting=csv.QUOTE_NONE
         )
-        exclude_pattern = re.compile('<[^<>]*>')
-        exclude_chars = ['&', ';', '[', ']']
 
-        # Dictionary of form {biocyc_id: {common_name, inchi, smiles}}
+        # Dictionary of form {biocyc_id: Chem(common_name, inchi, smiles)}
         chem_links = {}
-        for line in f:
-            if line.startswith('#'):
-                continue
-            entries = line.split('\t')
-            id = entries[0].strip()
-            inchi = entries[1].strip()
-            smiles = entries[2].strip()
-            name = entries[3].strip()
-            
-            # Exclude unwanted characters from common name
-            for char in exclude_chars:
-                name = name.replace(char, '')
-            name = re.sub(exclude_pattern, '', name)
-            if name.startswith('a '):
-                name = name[2:]
-            elif name.startswith('an '):
-                name = name[3:]
-
-            values = {
-                'name': name,
-                'inchi': inchi,
-                'smiles': smiles
-            }
-            chem_links[id] = values
+        for row in rows:
+            id, inchi, smiles, name = row[:4]
+            chem_links[sys.intern(id)] = Chem(_clean_name(name), inchi, smiles)
 
         f.close()
         return chem_links
 
     def load_rxn_links(self) -> Dict:
         f = open(
-            f'{self.input_root}/{self.org}/{self.rxn_links_name}'
+            f'{self.input_root}/{self.org}/{self.rxn_links_name}',
+            buffering=self.read_buffering
         )
 
         # Dictionary of form {rxn_id: [ec_nums]}
@@ -77,193 +292,156 @@ class BioCycData:
         for line in f:
             if line.startswith('#'):
                 continue
-            entries = line.split('\t')
-            if entries[1].isspace():
+            entries = line.rstrip('\r\n').split('\t')
+            if not entries[1]:
                 continue
-            id = entries[0].strip()
-            ecs = [ec[3:].strip() for ec in entries[1:]]
+            id = entries[0]
+            ecs = [ec[3:] for ec in entries[1:]]
             rxn_links[id] = ecs
         
         f.close()
         return rxn_links
 
     def extract_data(self):
-        self.chems = self.extract_chems()
-        self.rxns = self.extract_rxns()
-        self.write_data() 
-
-    def extract_chems(self) -> Dict:
-        f = open(
-            f'{self.input_root}/{self.org}/{self.chems_name}',
-            encoding='ISO-8859-1'
+        os.makedirs(f'{self.output_root}/{self.org}', exist_ok=True)
+
+        # Dictionary of form {biocyc_id: common_name} for naming reaction participants
+        self.chem_names = {}
+        self.write_data(
+            'chemicals.txt',
+            'id' + '\t' + 'name' + '\t' + 'inchi' + '\t' + 'smiles' + '\n',
+            (_format_chem(id, values) for id, values in self.extract_chems())
+        )
+        self.write_data(
+            'reactions.txt',
+            'reaction' + '\t' + 'reactants' + '\t' + 'products' + '\n',
+            (_format_rxn(values) for values in self.extract_rxns())
         )
-        exclude_pattern = re.compile('<[^<>]*>')
-        exclude_chars = ['&', ';', '[', ']']
-
-        chems = {}
-        id, name, inchi, smiles = (None, None, None, None)
-        while True:
-            line = f.readline()
-            if not line:
-                break
-            if line.startswith('//'):
-                chems[id] = self.impute_chem(
-                    id, 
-                    name, 
-                    inchi, 
-                    smiles
-                )
-                id, name, inchi, smiles = (None, None, None, None)
-                continue
-            
-            entries = line.split(' - ')
-            entry_type = entries[0]
-            if entry_type == 'UNIQUE-ID':
-                id = entries[1].strip()
-            elif entry_type == 'COMMON-NAME':
-                name = entries[1].strip()
-                for char in exclude_chars:
-                    name = name.replace(char, '')
-                name = re.sub(exclude_pattern, '', name)
-                if name.startswith('a '):
-                    name = name[2:]
-                elif name.startswith('an '):
-                    name = name[3:]
-            elif entry_type == 'NON-STANDARD-INCHI':
-                inchi = entries[1].strip()
-            elif entry_type == 'INCHI':
-                inchi = entries[1].strip()
-            elif entry_type == 'SMILES':
-                smiles = entries[1].strip()
 
+    def parse_records(
+        self,
+        path: str,
+        handlers: Dict,
+        fields: Tuple,
+        new_record: Callable
+    ) -> Iterator[Dict]:
+        f = open(path, encoding='ISO-8859-1', buffering=self.read_buffering)
+        yield from _iter_records(f, handlers, fields, new_record)
         f.close()
-        return chems
 
-    def impute_chem(self, id: str, name: str, inchi: str, smiles: str) -> Dict:
+    def extract_chems(self) -> Iterator[Tuple]:
+        # Records that still have missing fields after local imputation
+        work = []
+        # Records are written as they stream, so only the first of a repeated id is kept
+        seen = set()
+        for chem in self.parse_records(
+            f'{self.input_root}/{self.org}/{self.chems_name}',
+            _CHEM_HANDLERS,
+            _CHEM_FIELDS,
+            _new_chem
+        ):
+            # Compound ids are interned since they repeat across reactions and key every lookup
+            if chem['id'] is not None:
+                chem['id'] = sys.intern(chem['id'])
+            if chem['id'] in seen:
+                continue
+            seen.add(chem['id'])
+            record = self.impute_chem_local(**chem)
+            if None in (record.name, record.inchi, record.smiles):
+                work.append((chem['id'], record))
+                continue
+            self.chem_names[chem['id']] = record.name
+            yield chem['id'], record
+
+        # Resolve remaining fields from PubChem concurrently
+        ids = [id for id, _ in work]
+        records = [record for _, record in work]
+        with ThreadPoolExecutor(max_workers=self.pubchem_workers) as ex:
+            for id, record in zip(ids, ex.map(self.impute_chem_pubchem, records)):
+                self.chem_names[id] = record.name
+                yield id, record
+
+    def impute_chem_local(self, id: str, name: str, inchi: str, smiles: str) -> Chem:
         # Check if in compound links
-        try:
-            entry = self.chem_links[id]
-            in_links = True
-        except:
-            in_links = False
-        # Check if in BioCyc database
-        try:
-            compound = biocyc.get(id)
-            in_biocyc = not compound is None
-        except:
-            in_biocyc = False
+        entry = self.chem_links.get(id)
+        in_links = entry is not None
+        # Check if in BioCyc database, only if links cannot fill the gaps
+        need_from_biocyc = (
+            (name is None and not in_links)
+            or (inchi is None and not (in_links and entry.inchi != ''))
+        )
+        compound = self._biocyc_lookup(id) if need_from_biocyc else None
+        in_biocyc = not compound is None
 
         # Pass 1: Use links and BioCyc
         if name is None:
             if in_links:
-                name = entry['name']
+                name = entry.name
             elif in_biocyc:
-                name = compound.name
+                name = compound[0]
         if inchi is None:
-            if in_links and entry['inchi'] != '':
-                inchi = entry['inchi']
-            elif in_biocyc and compound.inchi != '':
-                inchi = compound.inchi
+            if in_links and entry.inchi != '':
+                inchi = entry.inchi
+            elif in_biocyc and compound[1] != '':
+                inchi = compound[1]
         if smiles is None and in_links:
-            smiles = entry['smiles']
+            smiles = entry.smiles
+
+        return Chem(name, inchi, smiles)
+
+    def impute_chem_pubchem(self, record: Chem) -> Chem:
+        name = record.name
+        inchi = record.inchi
+        smiles = record.smiles
 
         # Pass 2: Use PubChem
         if name is None:
             try:
-                c = pcp.get_compounds(inchi, 'inchi')
-                name = c[0].iupac_name
-            except: 
+                name = self._pcp_lookup(inchi, 'inchi')[0]
+            except Exception:
                 try:
-                    c = pcp.get_compounds(smiles, 'smiles')
-                    name = c[0].iupac_name
-                except:
+                    name = self._pcp_lookup(smiles, 'smiles')[0]
+                except Exception:
                     name = ''
                 
         if inchi is None:
             try:
-                c = pcp.get_compounds(name, 'name')
-                inchi = c[0].inchi
-            except:
+                inchi = self._pcp_lookup(name, 'name')[1]
+            except Exception:
                 try:
-                    c = pcp.get_compounds(smiles, 'smiles')
-                    inchi = c[0].inchi
-                except: 
+                    inchi = self._pcp_lookup(smiles, 'smiles')[1]
+                except Exception:
                     inchi = ''
         
         if smiles is None:
             try:
-                c = pcp.get_compounds(name, 'name')
-                smiles = c[0].canonical_smiles
-            except:
+                smiles = self._pcp_lookup(name, 'name')[2]
+            except Exception:
                 try:
-                    c = pcp.get_compounds(inchi, 'inchi')
-                    smiles = c[0].canonical_smiles
-                except: 
+                    smiles = self._pcp_lookup(inchi, 'inchi')[2]
+                except Exception:
                     smiles = ''
 
-        return {
-            'name': name,
-            'inchi': inchi,
-            'smiles': smiles
-        }
+        return Chem(name, inchi, smiles)
 
-    def extract_rxns(self) -> Dict:
-        f = open(
+    def extract_rxns(self) -> Iterator[Dict]:
+        seen = set()
+        for rxn in self.parse_records(
             f'{self.input_root}/{self.org}/{self.rxns_name}',
-            encoding='ISO-8859-1'
-        )
-
-        rxns = {}
-        id, left, right, direction = (None, [], [], None)
-        while True:
-            line = f.readline()
-            if not line: 
-                break
-            if line.startswith('//'):
-                rxns[id] = self.impute_rxn(
-                    id,
-                    left,
-                    right,
-                    direction
-                )
-                id, left, right, direction = (None, [], [], None)
+            _RXN_HANDLERS,
+            _RXN_FIELDS,
+            _new_rxn
+        ):
+            if rxn['id'] in seen:
                 continue
-
-            entries = line.split(' - ')
-            entry_type = entries[0].strip()
-            if entry_type == 'UNIQUE-ID':
-                id = entries[1].strip()
-            elif entry_type == 'LEFT':
-                left.append(entries[1].strip())
-            elif entry_type == 'RIGHT':
-                right.append(entries[1].strip())
-            elif entry_type == 'REACTION-DIRECTION':
-                dir = entries[1].strip()
-                if dir == 'REVERSIBLE':
-                    direction = 0
-                elif dir.endswith('LEFT-TO-RIGHT'):
-                    direction = 1
-                elif dir.endswith('RIGHT-TO-LEFT'):
-                    direction = 2
-                else:
-                    direction = -1
-
-        f.close()
-        return rxns
+            seen.add(rxn['id'])
+            rxn['left'] = [sys.intern(c) for c in rxn['left']]
+            rxn['right'] = [sys.intern(c) for c in rxn['right']]
+            yield self.impute_rxn(**rxn)
 
     def impute_rxn(self, id: str, left: List, right: List, direction: int) -> Dict:
-        reactant_names, product_names = [], []
-        for chem_id in left:
-            if chem_id in self.chems:
-                reactant_names.append(self.chems[chem_id]['name'])
-            else:
-                reactant_names.append(chem_id)
-            
-        for chem_id in right:
-            if chem_id in self.chems:
-                product_names.append(self.chems[chem_id]['name'])
-            else:
-                product_names.append(chem_id)
+        reactant_names = [self.chem_names.get(c, c) for c in left]
+        product_names = [self.chem_names.get(c, c) for c in right]
 
         return {
             'reactant_names': reactant_names,
@@ -273,46 +451,21 @@ class BioCycData:
             'direction': direction
         }
 
-    def write_data(self):
-        try:
-            os.mkdir(f'{self.output_root}/{self.org}')
-        except: pass
-
-        chems_file = open(f'{self.output_root}/{self.org}/chemicals.txt', 'w')
-        header = 'id' + '\t' + 'name' + '\t' + 'inchi' + '\t' + 'smiles' + '\n'
-        chems_file.write(header)
-
-        for id in self.chems:
-            values = self.chems[id]
-            line = id
-            line += '\t' + values['name']
-            if not values['inchi'] is None:
-                line += '\t' + values['inchi']
-            if not values['smiles'] is None:
-                line += '\t' + values['smiles']
-            line += '\n'
-            chems_file.write(line)
-        chems_file.close()
-
-        rxns_file = open(f'{self.output_root}/{self.org}/reactions.txt', 'w')
-        header = 'reaction' + '\t' + 'reactants' + '\t' + 'products' + '\n'
-        rxns_file.write(header)
-
-        for id in self.rxns:
-            values = self.rxns[id]
-            line = " + ".join(values['reactant_names'])
-            if values['direction'] == 0:
-                line += ' <=> '
-            elif values['direction'] == 1:
-                line += ' -> '
-            else:
-                line += ' <- '
-            line += " + ".join(values['product_names'])
-            line += '\t' + " ".join(values['reactant_ids'])
-            line += '\t' + " ".join(values['product_ids'])
-            line += '\n'
-            rxns_file.write(line)
-        rxns_file.close()
+    def write_data(self, fname: str, header: str, lines: Iterable[str]):
+        f = open(
+            f'{self.output_root}/{self.org}/{fname}',
+            'w',
+            buffering=self.write_buffering,
+            encoding='utf-8'
+        )
+        batch = [header]
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= self.write_batch:
+                f.writelines(batch)
+                batch.clear()
+        f.writelines(batch)
+        f.close()
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
@@ -325,15 +478,20 @@ if __name__ == "__main__":
         print('Invalid path')
         sys.exit(1)
 
-    for fname in os.listdir(f'{root}/{org}'):
-        if not os.path.isfile(f'{root}/{org}/{fname}'):
-            print(f'Cannot parse path {fname}')
-            sys.exit(1)
+    with os.scandir(f'{root}/{org}') as it:
+        for entry in it:
+            if not entry.is_file():
+                print(f'Cannot parse path {entry.name}')
+                sys.exit(1)
 
     # Must change this line for different organisms
     biocyc.set_organism('ECOLI')
+    share_session()
 
     extractor = BioCycData(org)
-    extractor.extract_data()
+    try:
+        extractor.extract_data()
+    finally:
+        extractor.close()
 
     print(f'Data written to outputs/{org}')
\ No newline at end of file